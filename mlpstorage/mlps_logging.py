@@ -159,3 +159,9 @@ def apply_logging_options(_logger, args):
             stream_handler.setFormatter(ColoredDebugFormatter())
             if stream_handler.level > DEBUG:
                 stream_handler.setLevel(DEBUG)
+
+
+def handler_accepts_level(_logger, level):
+    # The custom level methods call Logger._log directly and skip the logger level check, so only the handler
+    # levels decide whether a message at this level is emitted
+    return any(h.level <= level for h in _logger.handlers)
@@ -1,16 +1,66 @@
-import csv
-import json
+import functools
+import io
+import orjson
 import os.path
 import pprint
 import sys
 
+from collections import defaultdict
 from dataclasses import dataclass
 from typing import List, Dict, Any
 
-from mlpstorage.mlps_logging import setup_logging, apply_logging_options
+from mlpstorage.mlps_logging import setup_logging, apply_logging_options, handler_accepts_level, RIDICULOUS
 from mlpstorage.config import MLPS_DEBUG, BENCHMARK_TYPES, EXIT_CODE, PARAM_VALIDATION, LLM_MODELS, MODELS, ACCELERATORS
 from mlpstorage.rules import get_runs_files, BenchmarkVerifier, BenchmarkRun, Issue
-from mlpstorage.utils import flatten_nested_dict, remove_nan_values
+from mlpstorage.utils import flatten_and_clean
+
+# Results directories are often on network filesystems so write the report files through a large buffer
+REPORT_WRITE_BUFFER_SIZE = 1 << 20  # 1 MiB
+
+# Metric value types that print_results formats as numbers. Subclasses such as numpy scalars are included but
+# bool is not, so flags still print as True/False.
+_NUM = (int, float)
+_SEQ = (list, tuple)
+
+
+def _format_number(value):
+    return f'{value:,.1f}'
+
+
+def _format_percentage(value):
+    return f'{value:,.1f}%'
+
+
+def _format_number_list(value):
+    return ", ".join(f"{v:,.1f}" for v in value)
+
+
+def _format_percentage_list(value):
+    return ", ".join(f"{v:,.1f}%" for v in value)
+
+
+@functools.lru_cache(maxsize=None)
+def _metric_formatter(metric, value_type):
+    # The formatter only depends on the metric name and the value type so it is picked once per pair
+    is_percentage = "percentage" in metric.lower()
+    if issubclass(value_type, _NUM) and not issubclass(value_type, bool):
+        return _format_percentage if is_percentage else _format_number
+    elif issubclass(value_type, _SEQ):
+        return _format_percentage_list if is_percentage else _format_number_list
+    else:
+        return str
+
+
+def _csv_escape(value):
+    # Format a single CSV cell the same way csv.writer does with QUOTE_MINIMAL. Numbers never need quoting.
+    if isinstance(value, _NUM):
+        return str(value)
+    if value is None:
+        return ''
+    value = str(value)
+    if ',' in value or '"' in value or '\n' in value or '\r' in value:
+        return '"' + value.replace('"', '""') + '"'
+    return value
 
 @dataclass
 class Result:
@@ -45,15 +95,25 @@ class ReportGenerator:
             self.logger.error(f'Results directory {self.results_dir} does not exist')
             sys.exit(EXIT_CODE.FILE_NOT_FOUND)
 
+        self.json_file = os.path.join(self.results_dir, 'results.json')
+        self.csv_file = os.path.join(self.results_dir, 'results.csv')
+
         self.run_results = dict()           # {run_id : result_dict }
         self.workload_results = dict()      # {(model) | (model, accelerator) : result_dict }
+        self.run_result_dicts = dict()      # {run_id : benchmark_run.as_dict() }
+        self.run_category_labels = dict()   # {run_id : category.value.upper() }
         self.accumulate_results()
         self.print_results()
 
     def generate_reports(self):
         # Verify the results directory exists:
         self.logger.info(f'Generating reports for {self.results_dir}')
-        run_result_dicts = [report.benchmark_run.as_dict() for report in self.run_results.values()]
+        # Fail before writing anything rather than after the CSV has already been written
+        if not os.access(self.results_dir, os.W_OK):
+            self.logger.error(f'Results directory {self.results_dir} is not writable')
+            return EXIT_CODE.PERMISSION_DENIED
+
+        run_result_dicts = list(self.run_result_dicts.values())
 
         self.write_csv_file(run_result_dicts)
         self.write_json_file(run_result_dicts)
@@ -72,33 +132,19 @@ class ReportGenerator:
 
         self.logger.info(f'Accumulating results from {len(benchmark_runs)} runs')
         for benchmark_run in benchmark_runs:
-            self.logger.ridiculous(f'Processing run: \n{pprint.pformat(benchmark_run)}')
-            verifier = BenchmarkVerifier(benchmark_run, logger=self.logger)
-            category = verifier.verify()
-            issues = verifier.issues
-            result_dict = dict(
-                multi=False,
-                benchmark_run=benchmark_run,
-                benchmark_type=benchmark_run.benchmark_type,
-                benchmark_command=benchmark_run.command,
-                benchmark_model=benchmark_run.model,
-                issues=issues,
-                category=category,
-                metrics=benchmark_run.metrics
-            )
-            self.run_results[benchmark_run.run_id] = Result(**result_dict)
+            result = self._verify_run(benchmark_run)
+            self.run_results[benchmark_run.run_id] = result
+            self.run_result_dicts[benchmark_run.run_id] = benchmark_run.as_dict()
+            self.run_category_labels[benchmark_run.run_id] = result.category.value.upper()
 
         # Group runs for workload to run additional verifiers
         # These will be manually defined as these checks align with a specific submission version
         # I need to group by model. For training workloads we also group by accelerator but the same checker
         # is used based on model.
-        workload_runs = dict()
+        workload_runs = defaultdict(list)
 
         for benchmark_run in benchmark_runs:
-            workload_key = (benchmark_run.model, benchmark_run.accelerator)
-            if workload_key not in workload_runs.keys():
-                workload_runs[workload_key] = []
-            workload_runs[workload_key].append(benchmark_run)
+            workload_runs[(benchmark_run.model, benchmark_run.accelerator)].append(benchmark_run)
 
         for workload_key, runs in workload_runs.items():
             model, accelerator = workload_key
@@ -120,90 +166,124 @@ class ReportGenerator:
             )
             self.workload_results[workload_key] = Result(**result_dict)
 
+    def _verify_run(self, benchmark_run):
+        if handler_accepts_level(self.logger, RIDICULOUS):
+            # pformat is expensive for a full BenchmarkRun so only build it when the message will be logged
+            self.logger.ridiculous('Processing run: \n%s', pprint.pformat(benchmark_run))
+        verifier = BenchmarkVerifier(benchmark_run, logger=self.logger)
+        category = verifier.verify()
+        issues = verifier.issues
+        result_dict = dict(
+            multi=False,
+            benchmark_run=benchmark_run,
+            benchmark_type=benchmark_run.benchmark_type,
+            benchmark_command=benchmark_run.command,
+            benchmark_model=benchmark_run.model,
+            issues=issues,
+            category=category,
+            metrics=benchmark_run.metrics
+        )
+        return Result(**result_dict)
+
     def print_results(self):
-        print("\n========================= Results Report =========================")
-        for category in [PARAM_VALIDATION.CLOSED, PARAM_VALIDATION.OPEN, PARAM_VALIDATION.INVALID]:
-            print(f"\n------------------------- {category.value.upper()} Report -------------------------")
-            for result in self.run_results.values():
-                if result.category == category:
-                    print(f'\tRunID: {result.benchmark_run.run_id}')
-                    print(f'\t    Benchmark Type: {result.benchmark_type.value}')
-                    print(f'\t    Command: {result.benchmark_command}')
-                    print(f'\t    Model: {result.benchmark_model}')
-                    if result.issues:
-                        print(f'\t    Issues:')
-                        for issue in result.issues:
-                            print(f'\t\t- {issue}')
-                    else:
-                        print(f'\t\t- No issues found')
-
-                    if result.metrics:
-                        print(f'\t    Metrics:')
-                        for metric, value in result.metrics.items():
-                            if type(value) in (int, float):
-                                if "percentage" in metric.lower():
-                                    print(f'\t\t- {metric}: {value:,.1f}%')
-                                else:
-                                    print(f'\t\t- {metric}: {value:,.1f}')
-                            elif type(value) in (list, tuple):
-                                if "percentage" in metric.lower():
-                                    print(f'\t\t- {metric}: {", ".join(f"{v:,.1f}%" for v in value)}')
-                                else:
-                                    print(f'\t\t- {metric}: {", ".join(f"{v:,.1f}" for v in value)}')
-                            else:
-                                print(f'\t\t- {metric}: {value}')
-
-                    print("\n")
-
-        print("\n========================= Submissions Report =========================")
-        for category in [PARAM_VALIDATION.CLOSED, PARAM_VALIDATION.OPEN, PARAM_VALIDATION.INVALID]:
-            print(f"\n------------------------- {category.value.upper()} Report -------------------------")
-            for workload_key, workload_result in self.workload_results.items():
-                if workload_result.category == category:
-                    if workload_result.benchmark_model in LLM_MODELS:
-                        workload_id = f"Checkpointing - {workload_result.benchmark_model}"
-                    elif workload_result.benchmark_model in MODELS:
-                        accelerator = workload_result.benchmark_run[0].accelerator
-                        workload_id = (f"Training - {workload_result.benchmark_model}, "
-                                       f"Accelerator: {accelerator}")
-                    else:
-                        print(f'Unknown workload type: {workload_result.benchmark_model}')
-
-                    print(f'\tWorkloadID: {workload_id}')
-                    print(f'\t    Benchmark Type: {workload_result.benchmark_type.value}')
-                    if workload_result.benchmark_command:
-                        print(f'\t    Command: {workload_result.benchmark_command}')
-
-                    print(f'\t    Runs: ')
-                    for run in workload_result.benchmark_run:
-                        print(f'\t\t- {run.run_id} - [{self.run_results[run.run_id].category.value.upper()}]')
-
-                    if workload_result.issues:
-                        print(f'\t    Issues:')
-                        for issue in workload_result.issues:
-                            print(f'\t\t- {issue}')
-                    else:
-                        print(f'\t\t- No issues found')
-
-                    print("\n")
+        # Build the whole report and write it to stdout once instead of issuing a print() per line
+        buf = []
+        append = buf.append
+
+        categories = [PARAM_VALIDATION.CLOSED, PARAM_VALIDATION.OPEN, PARAM_VALIDATION.INVALID]
+        runs_by_category = {category: [] for category in categories}
+        for result in self.run_results.values():
+            runs_by_category[result.category].append(result)
+        workloads_by_category = {category: [] for category in categories}
+        for workload_result in self.workload_results.values():
+            workloads_by_category[workload_result.category].append(workload_result)
+
+        append("\n========================= Results Report =========================")
+        for category in categories:
+            cat_label = category.value.upper()
+            append(f"\n------------------------- {cat_label} Report -------------------------")
+            for result in runs_by_category[category]:
+                append(f'\tRunID: {result.benchmark_run.run_id}')
+                append(f'\t    Benchmark Type: {result.benchmark_type.value}')
+                append(f'\t    Command: {result.benchmark_command}')
+                append(f'\t    Model: {result.benchmark_model}')
+                if result.issues:
+                    append(f'\t    Issues:')
+                    for issue in result.issues:
+                        append(f'\t\t- {issue}')
+                else:
+                    append(f'\t\t- No issues found')
+
+                if result.metrics:
+                    append(f'\t    Metrics:')
+                    for metric, value in result.metrics.items():
+                        append(f'\t\t- {metric}: {_metric_formatter(metric, type(value))(value)}')
+
+                append("\n")
+
+        append("\n========================= Submissions Report =========================")
+        for category in categories:
+            cat_label = category.value.upper()
+            append(f"\n------------------------- {cat_label} Report -------------------------")
+            for workload_result in workloads_by_category[category]:
+                if workload_result.benchmark_model in LLM_MODELS:
+                    workload_id = f"Checkpointing - {workload_result.benchmark_model}"
+                elif workload_result.benchmark_model in MODELS:
+                    accelerator = workload_result.benchmark_run[0].accelerator
+                    workload_id = (f"Training - {workload_result.benchmark_model}, "
+                                   f"Accelerator: {accelerator}")
+                else:
+                    append(f'Unknown workload type: {workload_result.benchmark_model}')
+
+                append(f'\tWorkloadID: {workload_id}')
+                append(f'\t    Benchmark Type: {workload_result.benchmark_type.value}')
+                if workload_result.benchmark_command:
+                    append(f'\t    Command: {workload_result.benchmark_command}')
+
+                append(f'\t    Runs: ')
+                for run in workload_result.benchmark_run:
+                    append(f'\t\t- {run.run_id} - [{self.run_category_labels[run.run_id]}]')
+
+                if workload_result.issues:
+                    append(f'\t    Issues:')
+                    for issue in workload_result.issues:
+                        append(f'\t\t- {issue}')
+                else:
+                    append(f'\t\t- No issues found')
+
+                append("\n")
+
+        sys.stdout.write('\n'.join(buf))
+        sys.stdout.write('\n')
 
 
     def write_json_file(self, results):
-        json_file = os.path.join(self.results_dir,'results.json')
-        self.logger.info(f'Writing results to {json_file}')
-        with open(json_file, 'w') as f:
-            json.dump(results, f, indent=2)
+        self.logger.info(f'Writing results to {self.json_file}')
+        # Stream the records one at a time instead of building the whole document in memory. Each record is
+        # re-indented one level to match the layout of json.dump(results, f, indent=2).
+        option = orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS
+        with io.BufferedWriter(open(self.json_file, 'wb', buffering=0), buffer_size=REPORT_WRITE_BUFFER_SIZE) as f:
+            if not results:
+                f.write(b'[]')
+                return
+
+            f.write(b'[\n  ')
+            for i, result in enumerate(results):
+                if i:
+                    f.write(b',\n  ')
+                f.write(orjson.dumps(result, option=option).replace(b'\n', b'\n  '))
+            f.write(b'\n]')
 
     def write_csv_file(self, results):
-        csv_file = os.path.join(self.results_dir,'results.csv')
-        self.logger.info(f'Writing results to {csv_file}')
-        flattened_results = [flatten_nested_dict(r) for r in results]
-        flattened_results = [remove_nan_values(r) for r in flattened_results]
-        fieldnames = set()
-        for l in flattened_results:
-            fieldnames.update(l.keys())
-
-        with open(csv_file, 'w+', newline='') as file_object:
-            csv_writer = csv.DictWriter(f=file_object, fieldnames=sorted(fieldnames), lineterminator='\n')
-            csv_writer.writeheader()
-            csv_writer.writerows(flattened_results)
+        self.logger.info(f'Writing results to {self.csv_file}')
+        # Columns are kept in the order they are first seen, so the run identifiers lead and related
+        # metrics stay next to each other
+        field_index = dict()
+        flattened_results = [flatten_and_clean(r, {}, field_index=field_index) for r in results]
+
+        fieldnames = list(field_index)
+        rows = [[d.get(k, '') for k in fieldnames] for d in flattened_results]
+
+        with open(self.csv_file, 'w+', newline='', buffering=REPORT_WRITE_BUFFER_SIZE) as file_object:
+            file_object.write(','.join(_csv_escape(k) for k in fieldnames) + '\n')
+            file_object.writelines(','.join([_csv_escape(c) for c in row]) + '\n' for row in rows)
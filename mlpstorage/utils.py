@@ -3,7 +3,6 @@ import enum
 import io
 import json
 import logging
-import math
 import os
 import pprint
 import psutil
@@ -144,16 +143,44 @@ def flatten_nested_dict(nested_dict, parent_key='', separator='.'):
     return flat_dict
 
 
-def remove_nan_values(input_dict):
-    # Remove any NaN values from the input dictionary
-    ret_dict = dict()
-    for k, v in input_dict.items():
-        if type(v) in [float, int] and math.isnan(v):  # Ignore NaN values
+def flatten_and_clean(nested_dict, out, prefix='', separator='.', field_index=None):
+    """
+    Flatten a nested dictionary into `out` while dropping NaN values. This is equivalent to
+    remove_nan_values(flatten_nested_dict(nested_dict)) but writes every leaf directly into
+    a single output dictionary instead of building intermediate dictionaries per level.
+
+    Example:
+        Input: {'a': 1, 'b': {'c': 2, 'd': float('nan')}}
+        Output: {'a': 1, 'b.c': 2}
+
+    Args:
+        nested_dict (dict): The nested dictionary to flatten
+        out (dict): The dictionary the flattened leaves are written to
+        prefix (str): The key prefix including the trailing separator (used in recursion)
+        separator (str): The character to use for joining keys
+        field_index (dict): Optional dict that every flattened key is added to as a key, in first-seen order
+
+    Returns:
+        dict: The `out` dictionary
+    """
+    for key, value in nested_dict.items():
+        if isinstance(value, dict):
+            flatten_and_clean(value, out, f"{prefix}{key}{separator}", separator, field_index)
+        elif isinstance(value, float) and value != value:
+            # NaN is the only float that does not compare equal to itself
             continue
         else:
-            ret_dict[k] = v
+            new_key = f"{prefix}{key}"
+            out[new_key] = value
+            if field_index is not None:
+                field_index.setdefault(new_key, None)
+
+    return out
 
-    return ret_dict
+
+def remove_nan_values(input_dict):
+    # Remove any NaN values from the input dictionary. NaN is the only float that does not compare equal to itself
+    return {k: v for k, v in input_dict.items() if not (isinstance(v, float) and v != v)}
 
 
 class CommandExecutor: